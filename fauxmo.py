@@ -26,9 +26,17 @@ THE SOFTWARE.
 
 # For some discussion, see http://www.makermusings.com
 
+import argparse
+import array
+import atexit
 import email.utils
+import errno
+import fcntl
+import heapq
+import itertools
 import requests
 import select
+import signal
 import socket
 import struct
 import sys
@@ -37,12 +45,14 @@ import urllib
 import uuid
 import datetime
 
-from multiprocessing import Pool, TimeoutError
+from multiprocessing import Array, Pipe, Pool, Process, TimeoutError, Value, active_children
 
 import os
 
 from pims.wemocontrol import wemo_backend
-from webcam import webcam_snap
+from webcam import webcam_snap, start_archive
+from journal import Journal, create_schema, load_state
+from profiling import Profiler, profiled_call
 
 import RPi.GPIO as GPIO
 
@@ -69,9 +79,32 @@ SETUP_XML = """<?xml version="1.0"?>
 """
 
 
+# Our answer when asked for a switch's state (unknown reads as off)
+
+GET_STATE_SOAP = """<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>
+<u:GetBinaryStateResponse xmlns:u="urn:Belkin:service:basicevent:1">
+<BinaryState>%(state)d</BinaryState>
+</u:GetBinaryStateResponse>
+</s:Body></s:Envelope>
+"""
+
+
 DEBUG = False
 DRYRUN = False
 
+JOURNAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fauxmo_journal.db')
+
+# Where SIGUSR1 (cProfile) and SIGUSR2 (memory snapshot) write their results
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+PROFILE_SEC = 60
+
+# Linux value, for Pythons whose socket module doesn't define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Names of the network interfaces to answer on, e.g. ['eth0', 'wlan0'].
+# Leave empty to use every non-loopback IPv4 interface.
+INTERFACES = []
+
 def dbg(msg):
     global DEBUG
     if DEBUG:
@@ -83,6 +116,14 @@ def log(msg):
     dbg(msg)
 
 
+def sleep_for(sec):
+    """time.sleep that isn't cut short by a handled signal (on Python 2 it returns early)"""
+    deadline = time.time() + sec
+    while sec > 0:
+        time.sleep(sec)
+        sec = deadline - time.time()
+
+
 def toggle_pinout(pinout=27, sec=1, dry_run=False):
     if dry_run:
         dbg('Need dry_run=False for toggle_pinout to actually work.')
@@ -92,7 +133,7 @@ def toggle_pinout(pinout=27, sec=1, dry_run=False):
     GPIO.output(pinout, GPIO.HIGH)
     dbg("GPIO (BCM) PINOUT %d PUSHED HIGH" % pinout)
     dbg('sleep for %d sec' % sec)
-    time.sleep(sec)
+    sleep_for(sec)
     GPIO.output(pinout, GPIO.LOW)
     dbg("GPIO (BCM) PINOUT %d PULLED LOW" % pinout)
     GPIO.cleanup()  # Reset GPIO settings
@@ -126,39 +167,143 @@ class Poller(object):
         del(self.targets[fileno])
 
     def poll(self, timeout = 0):
-        if self.use_poll:
-            ready = self.poller.poll(timeout)
-        else:
+        try:
+            if self.use_poll:
+                ready = self.poller.poll(timeout)
+            else:
+                ready = []
+                if len(self.targets) > 0:
+                    (rlist, wlist, xlist) = select.select(self.targets.keys(), [], [], timeout)
+                    ready = [(x, None) for x in rlist]
+        except select.error, e:
+            # a signal (e.g. the profiling ones) interrupted us; nothing is ready
+            if e.args[0] != errno.EINTR:
+                raise
             ready = []
-            if len(self.targets) > 0:
-                (rlist, wlist, xlist) = select.select(self.targets.keys(), [], [], timeout)
-                ready = [(x, None) for x in rlist]
         for one_ready in ready:
             target = self.targets.get(one_ready[0], None)
             if target:
                 target.do_read(one_ready[0])
- 
 
-# Base class for a generic UPnP device. This is far from complete
-# but it supports either specified or automatic IP address and port
-# selection.
-class UpnpDevice(object):
-    this_host_ip = None
+
+# A simple in-process scheduler for delayed follow-up actions. Jobs sit
+# in a heap ordered by due time and are run from the main loop, so a
+# pending job costs no thread or process. Each job has a key; scheduling
+# a job under a key that is already pending replaces it.
+class Scheduler(object):
+
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}
+        self.counter = itertools.count()
+
+    def schedule(self, key, delay, func, args=(), kwargs=None):
+        if key in self.jobs:
+            dbg("Replacing pending job '%s'" % key)
+            self.jobs[key][3] = None
+        job = [time.time() + delay, next(self.counter), key, func, args, kwargs or {}]
+        self.jobs[key] = job
+        heapq.heappush(self.heap, job)
+        return key
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job:
+            # leave it in the heap, but mark it dead so run_pending skips it
+            job[3] = None
+            dbg("Cancelled pending job '%s'" % key)
+        return job is not None
+
+    def pending(self):
+        now = time.time()
+        return sorted([(round(job[0] - now, 1), key) for key, job in self.jobs.items()])
+
+    def run_pending(self, now=None):
+        if now is None:
+            now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, count, key, func, args, kwargs = heapq.heappop(self.heap)
+            if func is None:
+                continue
+            del(self.jobs[key])
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                dbg("Job '%s' failed: %s" % (key, e))
+
+
+# Enumerate the local IPv4 interfaces straight from the kernel (Linux
+# SIOCGIFCONF), so we know our addresses without any network round trip.
+# The list is cached once it has something in it; until then (e.g. we
+# started before DHCP finished) every lookup enumerates again.
+class NetworkInterfaces(object):
+    SIOCGIFCONF = 0x8912
+    SIOCGIFNETMASK = 0x891b
+    MAX_INTERFACES = 64
+    interfaces = []
 
     @staticmethod
-    def local_ip_address():
-        if not UpnpDevice.this_host_ip:
+    def get(refresh=False):
+        if refresh or not NetworkInterfaces.interfaces:
+            interfaces = []
             temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             try:
-                temp_socket.connect(('8.8.8.8', 53))
-                UpnpDevice.this_host_ip = temp_socket.getsockname()[0]
-            except:
-                UpnpDevice.this_host_ip = '127.0.0.1'
+                # sizeof(struct ifreq) is 40 on 64-bit and 32 on 32-bit (e.g. Raspbian)
+                ifreq_size = 40 if struct.calcsize('P') == 8 else 32
+                max_bytes = NetworkInterfaces.MAX_INTERFACES * ifreq_size
+                buf = array.array('B', '\0' * max_bytes)
+                ifconf = struct.pack('iP', max_bytes, buf.buffer_info()[0])
+                buf_len = struct.unpack('iP', fcntl.ioctl(temp_socket.fileno(), NetworkInterfaces.SIOCGIFCONF, ifconf))[0]
+                data = buf.tostring()[:buf_len]
+                for i in range(0, buf_len, ifreq_size):
+                    name = data[i:i + 16].split('\0', 1)[0]
+                    ip_address = socket.inet_ntoa(data[i + 20:i + 24])
+                    if ip_address.startswith('127.'):
+                        continue
+                    if INTERFACES and name not in INTERFACES:
+                        continue
+                    ifreq = fcntl.ioctl(temp_socket.fileno(), NetworkInterfaces.SIOCGIFNETMASK, struct.pack('256s', name))
+                    netmask = socket.inet_ntoa(ifreq[20:24])
+                    interfaces.append((name, ip_address, netmask))
+            except Exception, e:
+                dbg("Failed to enumerate network interfaces: %s" % e)
             del(temp_socket)
-            dbg("Got local address of %s" % UpnpDevice.this_host_ip)
-        return UpnpDevice.this_host_ip
+            if interfaces != NetworkInterfaces.interfaces:
+                dbg("Got local interfaces %s" % interfaces)
+            NetworkInterfaces.interfaces = interfaces
+        return NetworkInterfaces.interfaces
+
+    @staticmethod
+    def match(interfaces, remote_ip):
+        remote = struct.unpack('!L', socket.inet_aton(remote_ip))[0]
+        for name, ip_address, netmask in interfaces:
+            local = struct.unpack('!L', socket.inet_aton(ip_address))[0]
+            mask = struct.unpack('!L', socket.inet_aton(netmask))[0]
+            if local & mask == remote & mask:
+                return ip_address
+        return None
 
-    def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, other_headers = None, ip_address = None):
+    @staticmethod
+    def address_for(remote_ip):
+        """return our address on the interface whose subnet holds remote_ip,
+        or None if we have no interface address at all"""
+        ip_address = NetworkInterfaces.match(NetworkInterfaces.get(), remote_ip)
+        if not ip_address:
+            # maybe an interface came up (or changed) since we last looked
+            interfaces = NetworkInterfaces.get(refresh=True)
+            ip_address = NetworkInterfaces.match(interfaces, remote_ip)
+            if not ip_address and interfaces:
+                ip_address = interfaces[0][1]
+        return ip_address
+
+
+# Base class for a generic UPnP device. This is far from complete
+# but it supports either specified or automatic IP address and port
+# selection. Without a specified IP address the device listens on every
+# interface and advertises whichever address the searcher can reach.
+class UpnpDevice(object):
+
+    def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, other_headers = None, ip_address = None, reuse_port = False):
         self.listener = listener
         self.poller = poller
         self.port = port
@@ -168,13 +313,13 @@ class UpnpDevice(object):
         self.uuid = uuid.uuid4()
         self.other_headers = other_headers
 
-        if ip_address:
-            self.ip_address = ip_address
-        else:
-            self.ip_address = UpnpDevice.local_ip_address()
+        self.ip_address = ip_address
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.ip_address, self.port))
+        if reuse_port:
+            # let several worker processes listen on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind((self.ip_address or '', self.port))
         self.socket.listen(5)
         if self.port == 0:
             self.port = self.socket.getsockname()[1]
@@ -206,8 +351,21 @@ class UpnpDevice(object):
         
     def respond_to_search(self, destination, search_target):
         dbg("Responding to search for %s" % self.get_name())
+        ip_address = self.ip_address or NetworkInterfaces.address_for(destination[0])
+        try:
+            temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if ip_address:
+                temp_socket.bind((ip_address, 0))  # reply from the interface the search arrived on
+            else:
+                # no interface address known; let the kernel route the reply
+                # and tell us which address it will come from
+                temp_socket.connect(destination)
+                ip_address = temp_socket.getsockname()[0]
+        except socket.error, e:
+            dbg("WARNING: Can't reply to search from %s: %s" % (destination[0], e))
+            return
         date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-        location_url = self.root_url % {'ip_address' : self.ip_address, 'port' : self.port}
+        location_url = self.root_url % {'ip_address' : ip_address, 'port' : self.port}
         message = ("HTTP/1.1 200 OK\r\n"
                   "CACHE-CONTROL: max-age=86400\r\n"
                   "DATE: %s\r\n"
@@ -222,9 +380,11 @@ class UpnpDevice(object):
             for header in self.other_headers:
                 message += "%s\r\n" % header
         message += "\r\n"
-        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_socket.sendto(message, destination)
- 
+        try:
+            temp_socket.sendto(message, destination)
+        except socket.error, e:
+            dbg("WARNING: Failed to reply to search from %s: %s" % (destination[0], e))
+
 
 # This subclass does the bulk of the work to mimic a WeMo switch on
 # the network.
@@ -234,18 +394,19 @@ class Fauxmo(UpnpDevice):
     def make_uuid(name):
         return ''.join(["%x" % sum([ord(c) for c in name])] + ["%x" % ord(c) for c in "%sfauxmo!" % name])[:14]
 
-    def __init__(self, name, listener, poller, ip_address, port, action_handler = None):
+    def __init__(self, name, listener, poller, ip_address, port, action_handler = None, reuse_port = False, state_index = None):
         self.serial = self.make_uuid(name)
         self.name = name
+        self.state_index = state_index
         self.ip_address = ip_address
         persistent_uuid = "Socket-1_0-" + self.serial
         other_headers = ['X-User-Agent: redsonic']
-        UpnpDevice.__init__(self, listener, poller, port, "http://%(ip_address)s:%(port)s/setup.xml", "Unspecified, UPnP/1.0, Unspecified", persistent_uuid, other_headers=other_headers, ip_address=ip_address)
+        UpnpDevice.__init__(self, listener, poller, port, "http://%(ip_address)s:%(port)s/setup.xml", "Unspecified, UPnP/1.0, Unspecified", persistent_uuid, other_headers=other_headers, ip_address=ip_address, reuse_port=reuse_port)
         if action_handler:
             self.action_handler = action_handler
         else:
             self.action_handler = self
-        dbg("FauxMo device '%s' ready on %s:%s" % (self.name, self.ip_address, self.port))
+        dbg("FauxMo device '%s' ready on %s:%s" % (self.name, self.ip_address or 'all interfaces', self.port))
 
     def get_name(self):
         return self.name
@@ -271,11 +432,15 @@ class Fauxmo(UpnpDevice):
             if data.find('<BinaryState>1</BinaryState>') != -1:
                 # on
                 dbg("Responding to ON for %s" % self.name)
+                start = time.time()
                 success = self.action_handler.on()
+                self.record('on', start, success)
             elif data.find('<BinaryState>0</BinaryState>') != -1:
                 # off
                 dbg("Responding to OFF for %s" % self.name)
+                start = time.time()
                 success = self.action_handler.off()
+                self.record('off', start, success)
             else:
                 dbg("Unknown Binary State request:")
                 dbg(data)
@@ -295,9 +460,38 @@ class Fauxmo(UpnpDevice):
                            "\r\n"
                            "%s" % (len(soap), date_str, soap))
                 socket.send(message)
+        elif data.find('SOAPACTION: "urn:Belkin:service:basicevent:1#GetBinaryState"') != -1:
+            state = self.get_state()
+            dbg("Responding to GetBinaryState for %s: %s" % (self.name, state))
+            soap = GET_STATE_SOAP % {'state' : state or 0}
+            date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
+            message = ("HTTP/1.1 200 OK\r\n"
+                       "CONTENT-LENGTH: %d\r\n"
+                       "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
+                       "DATE: %s\r\n"
+                       "EXT:\r\n"
+                       "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                       "X-User-Agent: redsonic\r\n"
+                       "CONNECTION: close\r\n"
+                       "\r\n"
+                       "%s" % (len(soap), date_str, soap))
+            socket.send(message)
         else:
             dbg(data)
 
+    def get_state(self):
+        """1 for on, 0 for off, None if we don't know"""
+        if device_states is None or self.state_index is None or device_states[self.state_index] < 0:
+            return None
+        return device_states[self.state_index]
+
+    def record(self, command, start, success):
+        if success and device_states is not None and self.state_index is not None:
+            device_states[self.state_index] = 1 if command == 'on' else 0
+        if journal:
+            snapshot = getattr(self.action_handler, 'last_snapshot', None)
+            journal.record(self.name, command, time.time() - start, 'ok' if success else 'failed', snapshot)
+
     def on(self):
         return False
 
@@ -316,18 +510,17 @@ class Fauxmo(UpnpDevice):
 class UpnpBroadcastResponder(object):
 
     TIMEOUT = 0
+    JOIN_RETRY_SEC = 30
 
     def __init__(self):
         self.devices = []
+        self.joined = set()
 
     def init_socket(self):
         ok = True
         self.ip = '239.255.255.250'
         self.port = 1900
         try:
-            # This is needed to join a multicast group
-            self.mreq = struct.pack("4sl",socket.inet_aton(self.ip),socket.INADDR_ANY)
-
             # Set up server socket
             self.ssock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
             self.ssock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
@@ -335,21 +528,41 @@ class UpnpBroadcastResponder(object):
             try:
                 self.ssock.bind(('',self.port))
             except Exception, e:
-                dbg("WARNING: Failed to bind %s:%d: %s" , (self.ip,self.port,e))
+                dbg("WARNING: Failed to bind %s:%d: %s" % (self.ip,self.port,e))
                 ok = False
 
-            try:
-                self.ssock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,self.mreq)
-            except Exception, e:
-                dbg('WARNING: Failed to join multicast group:',e)
+            if not self.join_group():
                 ok = False
 
         except Exception, e:
-            dbg("Failed to initialize UPnP sockets:",e)
+            dbg("Failed to initialize UPnP sockets: %s" % e)
             return False
         if ok:
             dbg("Listening for UPnP broadcasts")
 
+    def join_group(self):
+        """join the multicast group on each of our interfaces, so searches
+        arrive no matter which network the Echo is on; until we have a real
+        interface, fall back to INADDR_ANY. Keep checking, since interfaces
+        can come up (e.g. wlan0 after eth0) long after we start"""
+        interface_ips = [one_interface[1] for one_interface in NetworkInterfaces.get(refresh=True)]
+        for interface_ip in (interface_ips or ['0.0.0.0']):
+            if interface_ip in self.joined:
+                continue
+            mreq = struct.pack("4s4s",socket.inet_aton(self.ip),socket.inet_aton(interface_ip))
+            try:
+                self.ssock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,mreq)
+                self.joined.add(interface_ip)
+                dbg("Joined multicast group on %s" % interface_ip)
+            except socket.error, e:
+                if e.args[0] == errno.EADDRINUSE:
+                    # the INADDR_ANY fallback already joined on this interface
+                    self.joined.add(interface_ip)
+                else:
+                    dbg("WARNING: Failed to join multicast group on %s: %s" % (interface_ip,e))
+        scheduler.schedule('upnp join', self.JOIN_RETRY_SEC, self.join_group)
+        return len(self.joined) > 0
+
     def fileno(self):
         return self.ssock.fileno()
 
@@ -429,45 +642,88 @@ def is_garage_open_time(dry_run=DRYRUN):
     return is_weekday_work_time(t1, t2) or is_sunday_mass_time(t3, t4)
 
 
-def sleep_and_wemo_off(sleep_sec, wemo_name):
+def wemo_off(wemo_name):
     """if weekday_work or sunday_mass times, then turn off wemo device"""
     if is_garage_open_time():
-        time.sleep(sleep_sec)  # wait several seconds to get downstairs & flip switch
         try:
             wemo_backend.wemo_dict[wemo_name].off()
-            msg = 'slept for %d sec and then turned off the %s' % (sleep_sec, wemo_name)
+            msg = 'turned off the %s' % wemo_name
         except ValueError:
-            msg = 'slept for %d sec, but caught ValueError turning off the %s' % (sleep_sec, wemo_name)
+            msg = 'caught ValueError turning off the %s' % wemo_name
     else:
-        msg = 'did nothing for "sleep_and_wemo_off" because it is not one of those days/times'
+        msg = 'did nothing for "wemo_off" because it is not one of those days/times'
     return msg
 
 
-def sleep_camsnap_torchoff(sleep_sec, cam_label, cam_dtm, wemo_name):
-    """sleep, snap pic and if weekday_work or sunday_mass times, then turn off wemo device"""
+def camsnap_torchoff(cam_label, cam_dtm, wemo_name):
+    """snap pic and if weekday_work or sunday_mass times, then turn off wemo device"""
     
-    time.sleep(sleep_sec)  # wait several seconds to get downstairs & flip switch
     webcam_snap(cam_label, cam_dtm)
         
     if is_garage_open_time():
         try:
             wemo_backend.wemo_dict[wemo_name].off()
-            msg = 'slept for %d sec, snapped pic, then turned off the %s' % (sleep_sec, wemo_name)
+            msg = 'snapped pic, then turned off the %s' % wemo_name
         except ValueError:
-            msg = 'slept for %d sec, snapped pic, but caught ValueError turning off the %s' % (sleep_sec, wemo_name)
+            msg = 'snapped pic, but caught ValueError turning off the %s' % wemo_name
     else:
-        msg = 'slept and snapped, but did nothing for "sleep_camsnap_torchoff" because it is not one of those days/times'
+        msg = 'snapped, but did nothing for "camsnap_torchoff" because it is not one of those days/times'
         
     return msg
 
 
 def just_squawk(s):
     """for multiprocessing, a callback that shows what's returned from a func eval
-    [ whenever that occurs asynchronously ] -- the func here is sleep_and_wemo_off
+    [ whenever that occurs asynchronously ] -- the func here is camsnap_torchoff
     """
     dbg('The just_squawk callback function %s.' % s)
 
 
+def run_async(func, args):
+    """hand func off to the worker pool so slow network/camera work does not stall the main loop"""
+    if profiler and profiler.profile:
+        # the pool doesn't get our signals, so profile the job over there
+        pool.apply_async(profiled_call, (PROFILE_DIR, profiler.top, func, args), callback=just_squawk)
+    else:
+        pool.apply_async(func, args, callback=just_squawk)
+
+
+def defer(key, delay, func, args):
+    """after delay sec, run func in the worker pool; replaces any pending job with the same key"""
+    if channel:
+        # we are a prefork worker, so the supervisor owns the scheduler
+        channel.send((key, delay, func, args))
+        return
+    scheduler.schedule(key, delay, run_async, (func, args))
+    dbg('Pending jobs: %s' % scheduler.pending())
+
+
+# Set up our singleton scheduler for delayed follow-up actions; the worker
+# pool those actions run in once they are due is started with the devices
+scheduler = Scheduler()
+pool = None
+
+# In a prefork worker, the pipe that carries deferred jobs to the supervisor
+channel = None
+
+# Set by SIGTERM; makes main_loop return
+stopping = False
+
+# This process's SIGUSR1/SIGUSR2 profiler; main_loop acts on its signals
+profiler = None
+
+# In prefork mode, when the supervisor's profiling window ends (0 when it
+# isn't profiling), in shared memory so that every worker can follow it
+profile_window_end = None
+
+# Our journal of device commands, opened in each process that serves devices
+journal = None
+
+# Last known state of each FAUXMOS device (1 on, 0 off, -1 unknown), in
+# shared memory so that every prefork worker sees the same states
+device_states = None
+
+
 # This is an example handler class. The Fauxmo class expects handlers to be
 # instances of objects that have on() and off() methods that return True
 # on success and False otherwise.
@@ -481,24 +737,24 @@ class RestApiHandler(object):
         self.off_cmd = off_cmd
         self.on_color = on_color
         self.off_color = off_color
-        self._pool = Pool(processes=3)  # start 3 worker processes
+        self.last_snapshot = None
 
     def on(self):
         dbg("The on_cmd received by %s" % self.__class__.__name__)
         for _ in range(3):
             bstick.set_color(name=self.on_color)
-            time.sleep(0.25)
+            sleep_for(0.25)
             bstick.turn_off()
-            time.sleep(0.25)
+            sleep_for(0.25)
         return True
 
     def off(self):
         dbg("The off_cmd received by %s" % self.__class__.__name__)
         for _ in range(3):
             bstick.set_color(name=self.off_color)
-            time.sleep(0.25)
+            sleep_for(0.25)
             bstick.turn_off()
-            time.sleep(0.25)
+            sleep_for(0.25)
         return True
 
 
@@ -510,20 +766,21 @@ class GarageRestApiHandler(RestApiHandler):
         dbg("The on_cmd received by %s" % self.__class__.__name__)
         for _ in range(3):
             bstick.set_color(name=self.on_color)
-            time.sleep(0.250)
+            sleep_for(0.250)
             bstick.turn_off()
-            time.sleep(0.250)
+            sleep_for(0.250)
 
         # ftw
         dtm = datetime.datetime.now()
-        webcam_snap('close', dtm)  # label this pic as 'close' since expecting garage is closed
+        self.last_snapshot = webcam_snap('close', dtm)  # label this pic as 'close' since expecting garage is closed
         toggle_pinout(dry_run=DRYRUN)  # raspberry pi hack to, in effect, push garage door button via relay
 
         # depending on day of week and time of day, we push garage door remote button...and
-        # use multiprocessing async to do "sleep and torch off" so Alexa does not timeout
-        #self._pool.apply_async(sleep_and_wemo_off, (20, 'torch'), callback=just_squawk)
-        self._pool.apply_async(sleep_camsnap_torchoff, (20, 'open', dtm, 'torch'), callback=just_squawk)
-        dbg('Delayed multiprocessing being done async now so Alexa does not timeout')
+        # schedule "snap and torch off" for later so Alexa does not timeout; this replaces
+        # any follow-up still pending from an earlier open/close
+        #defer('garage door', 20, wemo_off, ('torch',))
+        defer('garage door', 20, camsnap_torchoff, ('open', dtm, 'torch'))
+        dbg('Delayed follow-up scheduled so Alexa does not timeout')
 
         # return True is expected
         return True
@@ -534,25 +791,231 @@ class GarageRestApiHandler(RestApiHandler):
         dbg("The off_cmd received by %s" % self.__class__.__name__)
         for _ in range(3):
             bstick.set_color(name=self.off_color)
-            time.sleep(0.250)
+            sleep_for(0.250)
             bstick.turn_off()
-            time.sleep(0.250)
+            sleep_for(0.250)
 
         # ftw
         dtm = datetime.datetime.now()
-        webcam_snap('open', dtm)  # label this pic as 'open' since expecting garage is opened
+        self.last_snapshot = webcam_snap('open', dtm)  # label this pic as 'open' since expecting garage is opened
         toggle_pinout(dry_run=DRYRUN)  # raspberry pi hack to, in effect, push garage door button via relay
 
         # depending on day of week and time of day, we push garage door remote button...and
-        # use multiprocessing async to do "sleep and torch off" so Alexa does not timeout
-        #self._pool.apply_async(sleep_and_wemo_off, (20, 'torch'), callback=just_squawk)
-        self._pool.apply_async(sleep_camsnap_torchoff, (20, 'close', dtm, 'torch'), callback=just_squawk)
-        dbg('Delayed multiprocessing being done async now so Alexa does not timeout')
+        # schedule "snap and torch off" for later so Alexa does not timeout; this replaces
+        # any follow-up still pending from an earlier open/close
+        #defer('garage door', 20, wemo_off, ('torch',))
+        defer('garage door', 20, camsnap_torchoff, ('close', dtm, 'torch'))
+        dbg('Delayed follow-up scheduled so Alexa does not timeout')
 
         # return True is expected
         return True
 
 
+def restore_states():
+    """set up the journal file and seed device_states from it; call before forking"""
+    if not args.journal:
+        return
+    create_schema(args.journal)
+    states = load_state(args.journal)
+    for index, one_faux in enumerate(FAUXMOS):
+        if one_faux[0] in states:
+            command, ts = states[one_faux[0]]
+            device_states[index] = 1 if command == 'on' else 0
+            dbg("Restored state of %s: %s at %s" % (one_faux[0], command, datetime.datetime.fromtimestamp(ts)))
+
+
+def open_journal():
+    """open the command journal, if enabled"""
+    global journal
+    if args.journal:
+        journal = Journal(args.journal, log=dbg)
+        atexit.register(journal.close)
+
+
+def create_devices(listener, poller, reuse_port=False):
+    """create our FauxMo virtual switch devices"""
+    for index, one_faux in enumerate(FAUXMOS):
+        if len(one_faux) == 2:
+            # a fixed port wasn't specified, use a dynamic one
+            one_faux.append(0)
+        switch = Fauxmo(one_faux[0], listener, poller, None, one_faux[2], action_handler = one_faux[1], reuse_port = reuse_port, state_index = index)
+
+
+def request_stop(signum, frame):
+    """SIGTERM handler; main_loop notices and returns so we can shut down cleanly"""
+    global stopping
+    stopping = True
+
+
+def handle_sigterm():
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def shutdown():
+    """flush the journal, then take the pool and archive processes down with us;
+    skip the normal exit handlers, which can hang on a pool whose processes
+    were already killed"""
+    if journal:
+        journal.close()
+    if pool:
+        pool.close()  # don't replace pool processes as we terminate them
+    for child in active_children():
+        child.terminate()
+    os._exit(0)
+
+
+def reset_signals():
+    """Pool initializer: a pool process started after ours were installed
+    (to replace one that died) must still die on terminate()"""
+    for signum in (signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_DFL)
+
+
+def install_profiler(forward_to=None):
+    """a fresh Profiler for this process, so a forked worker doesn't inherit its parent's"""
+    global profiler
+    profiler = Profiler(PROFILE_DIR, PROFILE_SEC, scheduler=scheduler, log=dbg, window_end=profile_window_end)
+    profiler.install(forward_to=forward_to)
+
+
+def main_loop(poller, tick=None):
+    """poll sockets and run due jobs until asked to stop or something goes wrong"""
+    while not stopping:
+        try:
+            # Allow time for a ctrl-c to stop the process
+            poller.poll(100)
+            time.sleep(0.1)
+            scheduler.run_pending()
+            if profiler:
+                profiler.service()
+            if tick:
+                tick()
+        except Exception, e:
+            dbg(e)
+            break
+
+
+def run_worker(index, conn):
+    """body of a prefork worker; only worker 0 answers UPnP searches"""
+    global channel, scheduler
+    channel = conn
+    # don't run the supervisor's pending jobs or keep its profile going here
+    scheduler = Scheduler()
+    if profiler and profiler.profile:
+        profiler.profile.disable()
+    install_profiler()
+    # profile from the start if we were forked during a profiling window
+    profiler.follow()
+    p = Poller()
+    u = UpnpBroadcastResponder()
+    if index == 0:
+        u.init_socket()
+        p.add(u)
+    open_journal()
+    create_devices(u, p, reuse_port=True)
+    dbg("Worker %d entering main loop" % index)
+    try:
+        main_loop(p)
+    finally:
+        if journal:
+            journal.close()  # a Process exits without running atexit
+
+
+# In prefork mode the supervisor starts N worker processes that all bind
+# the device ports with SO_REUSEPORT, so the kernel spreads connections
+# across them. Worker 0 also answers UPnP searches. Workers send their
+# deferred jobs back over a pipe, so the supervisor's single scheduler
+# sees every open/close, and keep device states in the shared
+# device_states table. A worker that dies is restarted.
+class Supervisor(object):
+
+    # a worker that dies within MAX_BACKOFF_SEC of starting is restarted
+    # after 1, 2, 4, ... up to MAX_BACKOFF_SEC seconds
+    MAX_BACKOFF_SEC = 60
+    STOP_TIMEOUT_SEC = 5
+
+    def __init__(self, poller, num_workers):
+        self.poller = poller
+        self.num_workers = num_workers
+        self.workers = {}
+        self.started = {}
+        self.backoff = {}
+        self.restart_at = {}
+        self.channels = {}
+        self.reserved_sockets = []
+
+    def reserve_ports(self):
+        # every worker must bind the same port, so pick the dynamic ones
+        # here and hold them (bound, not listening) while we run
+        for one_faux in FAUXMOS:
+            if len(one_faux) == 2 or one_faux[2] == 0:
+                temp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                temp_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                temp_socket.bind(('', 0))
+                one_faux[2:] = [temp_socket.getsockname()[1]]
+                self.reserved_sockets.append(temp_socket)
+                dbg("Reserved port %d for %s" % (one_faux[2], one_faux[0]))
+
+    def start(self):
+        self.reserve_ports()
+        for index in range(self.num_workers):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        recv_conn, send_conn = Pipe(duplex=False)
+        worker = Process(target=run_worker, args=(index, send_conn))
+        worker.daemon = True
+        worker.start()
+        send_conn.close()
+        self.workers[index] = worker
+        self.started[index] = time.time()
+        self.channels[recv_conn.fileno()] = recv_conn
+        self.poller.add(self, recv_conn.fileno())
+        dbg("Started worker %d with pid %d" % (index, worker.pid))
+
+    def check_workers(self):
+        now = time.time()
+        for index, worker in self.workers.items():
+            if worker.is_alive():
+                continue
+            if index not in self.restart_at:
+                if now - self.started[index] >= self.MAX_BACKOFF_SEC:
+                    self.backoff[index] = 0  # it ran a good while, restart at once
+                else:
+                    self.backoff[index] = min(max(2 * self.backoff.get(index, 0), 1), self.MAX_BACKOFF_SEC)
+                self.restart_at[index] = now + self.backoff[index]
+                dbg("Worker %d (pid %d) exited with code %s, restarting in %d sec" % (index, worker.pid, worker.exitcode, self.backoff[index]))
+            if now >= self.restart_at[index]:
+                del(self.restart_at[index])
+                self.start_worker(index)
+
+    def do_read(self, fileno):
+        conn = self.channels[fileno]
+        try:
+            key, delay, func, args = conn.recv()
+        except EOFError:
+            # worker went away; check_workers will start a new one
+            self.poller.remove(self, fileno)
+            del(self.channels[fileno])
+            conn.close()
+            return
+        defer(key, delay, func, args)
+
+    def worker_pids(self):
+        return [worker.pid for worker in self.workers.values() if worker.is_alive()]
+
+    def stop(self):
+        # ask the workers to stop first and give them time to flush their
+        # journals, then take everything else down with us
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers.values():
+            worker.join(self.STOP_TIMEOUT_SEC)
+        shutdown()
+
+
 # Each entry is a list with the following elements:
 #
 # name of the virtual switch
@@ -570,12 +1033,46 @@ FAUXMOS = [
 ]
 
 
-if len(sys.argv) > 1 and sys.argv[1] == '-d':
+parser = argparse.ArgumentParser(description="Emulated Belkin WeMo devices for the Amazon Echo")
+parser.add_argument("-d", "--debug", action="store_true", help="print debug output")
+parser.add_argument("-w", "--workers", type=int, default=0, help="number of prefork worker processes (default 0, run everything in one process)")
+parser.add_argument("--no-archive", action="store_true", help="don't index, thumbnail or prune webcam snapshots")
+parser.add_argument("-j", "--journal", default=JOURNAL_FILE, help="sqlite file to journal commands to, '' for none (default '" + JOURNAL_FILE + "')")
+args = parser.parse_args()
+if args.debug:
     DEBUG = True
 
+# Start the snapshot archive, then the worker pool, so that the pool and
+# every other process that snaps inherits the archive
+if not args.no_archive:
+    start_archive(log=dbg)
+pool = Pool(processes=3, initializer=reset_signals)  # start 3 worker processes
+
 # Set up our singleton for polling the sockets for data ready
 p = Poller()
 
+# Set up the device state table before forking anything that shares it
+device_states = Array('b', [-1] * len(FAUXMOS))
+restore_states()
+
+if args.workers > 0:
+    # Prefork mode: the workers own the devices, we supervise them and
+    # run the deferred jobs they send us
+    supervisor = Supervisor(p, args.workers)
+    handle_sigterm()
+    profile_window_end = Value('d', 0)
+    install_profiler(forward_to=supervisor.worker_pids)
+    supervisor.start()
+
+    dbg("Entering supervisor loop\n")
+    try:
+        main_loop(p, supervisor.check_workers)
+    finally:
+        supervisor.stop()
+
+# Let SIGUSR1/SIGUSR2 profile us while we run
+install_profiler()
+
 # Set up our singleton listener for UPnP broadcasts
 u = UpnpBroadcastResponder()
 u.init_socket()
@@ -584,23 +1081,17 @@ u.init_socket()
 # when a broadcast is received.
 p.add(u)
 
-# Create our FauxMo virtual switch devices
-for one_faux in FAUXMOS:
-    if len(one_faux) == 2:
-        # a fixed port wasn't specified, use a dynamic one
-        one_faux.append(0)
-    switch = Fauxmo(one_faux[0], u, p, None, one_faux[2], action_handler = one_faux[1])
+# Open our command journal and create our FauxMo virtual switch devices
+open_journal()
+create_devices(u, p)
 
 dbg("Entering main loop\n")
 
-while True:
-    try:
-        # Allow time for a ctrl-c to stop the process
-        p.poll(100)
-        time.sleep(0.1)
-    except Exception, e:
-        dbg(e)
-        break
+handle_sigterm()
+try:
+    main_loop(p)
+finally:
+    shutdown()
 
 # NOTE TO SELF:
 #  pgrep -afl python
@@ -15,8 +15,11 @@ DIR=/home/ken/dev/programs/python/fauxmo
 DAEMON=$DIR/fauxmo.py
 DAEMON_NAME=fauxmo
 
+# Number of prefork worker processes serving the devices (0 runs everything in one process)
+DAEMON_WORKERS=0
+
 # Add any command line options for your daemon here
-DAEMON_OPTS="-d"
+DAEMON_OPTS="-d -w $DAEMON_WORKERS"
 
 # This next line determines what user the script runs as.
 # Root generally not recommended but necessary if you are using the Raspberry Pi GPIO from Python.
@@ -53,8 +56,18 @@ case "$1" in
         status_of_proc "$DAEMON_NAME" "$DAEMON" && exit 0 || exit $?
         ;;
 
+    profile)
+        # toggle cProfile for a while; results land in $DIR/profiles
+        kill -USR1 $(cat $PIDFILE)
+        ;;
+
+    memory)
+        # write a memory snapshot diff to $DIR/profiles
+        kill -USR2 $(cat $PIDFILE)
+        ;;
+
     *)
-        echo "Usage: /etc/init.d/$DAEMON_NAME {start|stop|restart|status}"
+        echo "Usage: /etc/init.d/$DAEMON_NAME {start|stop|restart|status|profile|memory}"
         exit 1
         ;;
 
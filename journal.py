@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+import Queue
+
+# Append-only journal of device commands in SQLite (WAL mode). Callers only
+# put events on a queue; a writer thread commits them in batches, so the
+# disk is never touched on the request path. A small state table holds the
+# last command per device, so load_state restores state without a scan.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    device TEXT NOT NULL,
+    command TEXT NOT NULL,
+    latency REAL,
+    outcome TEXT,
+    snapshot TEXT
+);
+CREATE INDEX IF NOT EXISTS events_device ON events (device, id);
+CREATE TABLE IF NOT EXISTS state (
+    device TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+"""
+
+
+def quiet(msg):
+    pass
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')  # WAL keeps this crash-safe
+    return conn
+
+
+def create_schema(path):
+    """create the tables if they're missing; do this once before forking
+    processes that each open a Journal"""
+    conn = connect(path)
+    conn.executescript(SCHEMA)
+    conn.close()
+
+
+def read_only(path):
+    # no PRAGMAs, no DDL; a reader shouldn't change the file
+    if not os.path.exists(path):
+        return None
+    return sqlite3.connect(path, timeout=10)
+
+
+def load_state(path):
+    """last command per device, as {device: (command, ts)}"""
+    conn = read_only(path)
+    if conn is None:
+        return {}
+    try:
+        return dict((device, (command, ts)) for device, command, ts in conn.execute('SELECT device, command, ts FROM state'))
+    except sqlite3.OperationalError:
+        return {}  # no state table yet
+    finally:
+        conn.close()
+
+
+def last_events(path, device=None, limit=50):
+    """newest first, as (ts, device, command, latency, outcome, snapshot) tuples"""
+    conn = read_only(path)
+    if conn is None:
+        return []
+    try:
+        if device is None:
+            return conn.execute('SELECT ts, device, command, latency, outcome, snapshot FROM events '
+                                'ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return conn.execute('SELECT ts, device, command, latency, outcome, snapshot FROM events '
+                            'WHERE device = ? ORDER BY id DESC LIMIT ?', (device, limit)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+
+class Journal(object):
+
+    # the file must already have its tables; see create_schema
+
+    def __init__(self, path, batch_size=50, flush_sec=0.5, log=None):
+        self.path = path
+        self.log = log or quiet
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._writer, name='journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, device, command, latency, outcome, snapshot=None):
+        """queue one event; returns at once, the writer thread commits it"""
+        self.queue.put((time.time(), device, command, latency, outcome, snapshot))
+
+    def close(self):
+        """commit whatever is still queued, then stop the writer"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _writer(self):
+        conn = connect(self.path)
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_sec
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                with conn:
+                    conn.executemany('INSERT INTO events (ts, device, command, latency, outcome, snapshot) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)', batch)
+                    # a failed command didn't change the device, so it doesn't change its state
+                    conn.executemany('INSERT OR REPLACE INTO state (device, command, ts) VALUES (?, ?, ?)',
+                                     [(device, command, ts) for ts, device, command, latency, outcome, snapshot in batch
+                                      if outcome == 'ok'])
+            except sqlite3.Error, e:
+                self.log('Journal: dropped %d events: %s' % (len(batch), e))
+        conn.close()
+
+
+if __name__ == '__main__':
+
+    # e.g. ./journal.py fauxmo_journal.db "garage door" 50
+    import datetime
+    path = sys.argv[1]
+    device = sys.argv[2] if len(sys.argv) > 2 else None
+    limit = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    if not os.path.exists(path):
+        sys.exit("No journal at %s" % path)
+    for ts, device, command, latency, outcome, snapshot in last_events(path, device, limit):
+        print datetime.datetime.fromtimestamp(ts), device, command, '%.3fs' % latency, outcome, snapshot or ''
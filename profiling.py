@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import os
+import gc
+import sys
+import time
+import signal
+import pstats
+import cProfile
+import datetime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2: fall back to counting live objects by type
+
+# Opt-in profiling of a running fauxmo, driven by signals:
+#   kill -USR1 <pid>  start cProfile for window_sec (a second USR1 stops it early)
+#   kill -USR2 <pid>  write a memory snapshot, diffed against the previous one
+# Results go to timestamped files in out_dir. Deferred jobs that are handed
+# to the worker pool while profiling is on get profiled there, each into
+# its own file (see profiled_call).
+#
+# With several processes, one leads: it toggles on USR1, publishes the end
+# of its profiling window in a shared window_end value (0 when off) and
+# passes the signal on. The others follow window_end rather than toggling,
+# so a process started mid-window can't get out of step.
+
+# Entry points we always want broken out in the summary: the main loop's
+# Poller.poll, each device's handle_request, the action handlers' on/off
+# and the deferred follow-up jobs
+ENTRY_POINTS = r'\((poll|handle_request|on|off|camsnap_torchoff|wemo_off)\)$'
+
+
+def quiet(msg):
+    pass
+
+
+def out_file(out_dir, kind):
+    """timestamped base name (no extension) for a result file, with a
+    counter if that second is already taken; every kind writes a .txt"""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    dstr = datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+    stem = os.path.join(out_dir, 'fauxmo_%s_%d_%s' % (kind, os.getpid(), dstr))
+    base = stem
+    count = 1
+    while os.path.exists(base + '.txt'):
+        count += 1
+        base = '%s_%d' % (stem, count)
+    return base
+
+
+def write_profile(profile, base, top):
+    """the raw .prof, plus a .txt summary with the entry points broken out"""
+    profile.dump_stats(base + '.prof')
+    with open(base + '.txt', 'w') as summary:
+        stats = pstats.Stats(profile, stream=summary)
+        stats.strip_dirs().sort_stats('cumulative')
+        stats.print_stats(top)
+        stats.print_callees(ENTRY_POINTS)
+
+
+def profiled_call(out_dir, top, func, args):
+    """run func(*args) under cProfile and write its results; for the deferred
+    jobs that run in the worker pool, which never sees our signals"""
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        write_profile(profile, out_file(out_dir, 'deferred_' + func.__name__), top)
+
+
+class Profiler(object):
+
+    def __init__(self, out_dir, window_sec=60, top=25, scheduler=None, log=None, window_end=None):
+        self.out_dir = out_dir
+        self.window_sec = window_sec
+        self.top = top
+        self.scheduler = scheduler
+        self.log = log or quiet
+        self.profile = None
+        self.memory_baseline = None
+        self.forward_to = None
+        self.window_end = window_end
+        self.pending = []
+
+    def install(self, profile_signal=signal.SIGUSR1, memory_signal=signal.SIGUSR2, forward_to=None):
+        """hook up the signals; forward_to, if given, returns pids to pass the signals on to
+        and makes us the leader. The handlers only note the signal; call service() from the
+        main loop to act on it."""
+        self.forward_to = forward_to
+        self.profile_signal = profile_signal
+        self.memory_signal = memory_signal
+        for signum in (profile_signal, memory_signal):
+            signal.signal(signum, self.on_signal)
+            # restart interrupted system calls instead of raising EINTR
+            signal.siginterrupt(signum, False)
+
+    def on_signal(self, signum, frame):
+        self.pending.append(signum)
+
+    def service(self):
+        """do the work for any signals received since the last call"""
+        while self.pending:
+            signum = self.pending.pop(0)
+            if signum == self.profile_signal:
+                if self.following():
+                    self.follow()
+                elif self.profile:
+                    self.stop()
+                else:
+                    self.start()
+            elif signum == self.memory_signal:
+                self.memory_snapshot()
+            # after acting, so followers see the leader's new window_end
+            self.forward(signum)
+
+    def following(self):
+        return self.window_end is not None and not self.forward_to
+
+    def follow(self):
+        """start or stop to match the leader's window"""
+        remaining = self.window_end.value - time.time()
+        if remaining > 0 and not self.profile:
+            self.start(remaining)
+        elif remaining <= 0 and self.profile:
+            self.stop()
+
+    def forward(self, signum):
+        if self.forward_to:
+            for pid in self.forward_to():
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+    def start(self, window_sec=None):
+        window_sec = window_sec or self.window_sec
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        if self.scheduler:
+            self.scheduler.schedule('profiler', window_sec, self.stop)
+        if self.window_end is not None and not self.following():
+            self.window_end.value = time.time() + window_sec
+        self.log('Profiling pid %d for %d sec' % (os.getpid(), window_sec))
+
+    def stop(self):
+        if not self.profile:
+            return
+        self.profile.disable()
+        if self.scheduler:
+            self.scheduler.cancel('profiler')
+        if self.window_end is not None and not self.following():
+            self.window_end.value = 0
+        base = out_file(self.out_dir, 'profile')
+        write_profile(self.profile, base, self.top)
+        self.profile = None
+        self.log('Wrote %s.prof and %s.txt' % (base, base))
+
+    def memory_snapshot(self):
+        base = out_file(self.out_dir, 'memory')
+        with open(base + '.txt', 'w') as out:
+            if tracemalloc:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                snapshot = tracemalloc.take_snapshot()
+                if self.memory_baseline:
+                    out.write('Top %d allocation changes by line since the previous snapshot\n' % self.top)
+                    for stat in snapshot.compare_to(self.memory_baseline, 'lineno')[:self.top]:
+                        out.write('%s\n' % stat)
+                else:
+                    out.write('tracemalloc started; send the signal again for a diff. Top %d by line so far\n' % self.top)
+                    for stat in snapshot.statistics('lineno')[:self.top]:
+                        out.write('%s\n' % stat)
+            else:
+                gc.collect()
+                snapshot = {}
+                for obj in gc.get_objects():
+                    name = type(obj).__name__
+                    snapshot[name] = snapshot.get(name, 0) + 1
+                previous = self.memory_baseline or {}
+                changes = sorted([(count - previous.get(name, 0), count, name) for name, count in snapshot.items()], reverse=True)
+                out.write('Top %d live object count changes by type since the previous snapshot\n' % self.top)
+                for change, count, name in changes[:self.top]:
+                    out.write('%+8d %8d %s\n' % (change, count, name))
+        self.memory_baseline = snapshot
+        self.log('Wrote %s.txt' % base)
+
+
+if __name__ == '__main__':
+
+    # e.g. ./profiling.py profiles/fauxmo_profile_1234_2017-08-31_05_45_00.prof
+    stats = pstats.Stats(sys.argv[1])
+    stats.strip_dirs().sort_stats('cumulative').print_stats(25)
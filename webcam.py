@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
+import time
+import glob
+import sqlite3
+import datetime
+import Queue
 import wget
+from multiprocessing import Process, Queue as ProcessQueue
 from private.myfoscam import URL, OUTDIR
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # no thumbnails without PIL
+
 # NOTE: not in repository, but under private subdir in project, we have:
 # __init__.py  -- blank file
 # myfoscam.py  -- python file that has 2 globals: URL, which has private info,  and OUTDIR
@@ -25,16 +37,234 @@ class RedirectStdStreams(object):
         sys.stderr = self.old_stderr
 
 
+def quiet(msg):
+    pass
+
+
+def unique_out_file(out_dir, dtm, label):
+    """second-resolution name, with a counter if that second+label is already taken"""
+    stem = os.path.join(out_dir, dtm.strftime('%Y-%m-%d_%H_%M_%S') + '_' + label)
+    out_file = stem + '.jpg'
+    count = 1
+    while os.path.exists(out_file):
+        count += 1
+        out_file = '%s_%d.jpg' % (stem, count)
+    return out_file
+
+
+# What unique_out_file writes (2017-08-31_05_45_07_close_2.jpg), and the
+# older minute-resolution names (2017-08-31_05_45_close.jpg)
+SNAPSHOT_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2}_\d{2}_\d{2}(?:_\d{2})?)_(.+?)(?:_\d+)?\.jpg$')
+
+
+def parse_snapshot_name(filename):
+    """return (ts, label) from a snapshot's name, or None if it isn't one of ours"""
+    match = SNAPSHOT_NAME.match(os.path.basename(filename))
+    if not match:
+        return None
+    stamp, label = match.groups()
+    dtm = datetime.datetime.strptime(stamp, '%Y-%m-%d_%H_%M_%S' if stamp.count('_') == 3 else '%Y-%m-%d_%H_%M')
+    return time.mktime(dtm.timetuple()), label
+
+
 def webcam_snap(label, dtm, out_dir=OUTDIR):
     devnull = open(os.devnull, 'w')
-    dstr = dtm.strftime('%Y-%m-%d_%H_%M')
-    out_file = os.path.join(out_dir, dstr + '_' + label + '.jpg')
+    out_file = unique_out_file(out_dir, dtm, label)
     with RedirectStdStreams(stdout=devnull):
         # you'll never see stdout with devnull for stdout
         filename = wget.download(URL, out=out_file)
-    
-    
+    if archive:
+        archive.add(filename, label, dtm)
+    return filename
+
+
+# Keeps the snapshot directory in check: indexes each new snapshot by time
+# and label (sqlite file in the snapshot directory), makes a thumbnail, and
+# deletes the oldest snapshots once the archive is over its size or age
+# limit. All of it runs in one separate process fed by a queue, so taking a
+# snapshot never waits on it. Start it before forking anything that snaps.
+class SnapshotArchive(object):
+
+    THUMB_SIZE = (160, 120)
+    DELETE_BATCH = 100
+
+    def __init__(self, out_dir=OUTDIR, max_bytes=2 * 1024 ** 3, max_age_days=90, log=None):
+        self.out_dir = out_dir
+        self.log = log or quiet
+        self.thumb_dir = os.path.join(out_dir, 'thumbs')
+        self.index_file = os.path.join(out_dir, 'snapshots.db')
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.queue = ProcessQueue()
+        self.process = None
+
+    def start(self):
+        self.process = Process(target=self._run, args=(os.getpid(),), name='snapshot archive')
+        self.process.daemon = True
+        self.process.start()
+
+    def add(self, filename, label, dtm):
+        """hand a new snapshot to the archive process; does not block"""
+        self.queue.put((filename, label, time.mktime(dtm.timetuple()) + dtm.microsecond / 1e6))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_file, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _open_index(self):
+        """set up thumbs dir and index, index what's already there and prune;
+        returns the index connection, or None if that failed"""
+        try:
+            if not os.path.isdir(self.thumb_dir):
+                os.makedirs(self.thumb_dir)
+            conn = self._connect()
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    path TEXT PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    label TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    thumb TEXT
+                );
+                CREATE INDEX IF NOT EXISTS snapshots_ts ON snapshots (ts);
+                CREATE INDEX IF NOT EXISTS snapshots_label ON snapshots (label, ts);
+            """)
+            if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+                self._index_existing(conn)
+                conn.execute('PRAGMA user_version = 1')  # done, even if it's pruned empty later
+        except Exception, e:
+            self.log('Snapshot archive: failed to open %s: %s' % (self.index_file, e))
+            return None
+        self._enforce_retention(conn)
+        return conn
+
+    def _run(self, parent_pid):
+        # never let an error end this loop: producers keep putting into our
+        # queue, so if we stopped reading it would grow in every one of them
+        conn = None
+        while True:
+            if conn is None:
+                conn = self._open_index()
+            try:
+                batch = [self.queue.get(timeout=5)]
+            except Queue.Empty:
+                if os.getppid() != parent_pid:
+                    return  # fauxmo is gone, so are we
+                continue
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if conn is None:
+                self.log('Snapshot archive: no index, %d snapshots left unindexed' % len(batch))
+                continue
+            try:
+                rows = []
+                for filename, label, ts in batch:
+                    if os.path.exists(filename):
+                        rows.append((filename, ts, label, os.path.getsize(filename), self._make_thumb(filename)))
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO snapshots (path, ts, label, size, thumb) VALUES (?, ?, ?, ?, ?)', rows)
+            except Exception, e:
+                self.log('Snapshot archive: failed to index %d snapshots: %s' % (len(batch), e))
+            self._enforce_retention(conn)
+
+    def _index_existing(self, conn):
+        # one-time pickup of snapshots taken before there was an index
+        rows = []
+        for filename in glob.glob(os.path.join(self.out_dir, '*.jpg')):
+            parsed = parse_snapshot_name(filename)
+            if parsed is None:
+                self.log('Snapshot archive: %s is not a snapshot name, indexing it by mtime' % filename)
+                parsed = (os.path.getmtime(filename), 'unknown')
+            rows.append((filename, parsed[0], parsed[1], os.path.getsize(filename), None))
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO snapshots (path, ts, label, size, thumb) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _make_thumb(self, filename):
+        if Image is None:
+            return None
+        thumb = os.path.join(self.thumb_dir, os.path.basename(filename))
+        try:
+            image = Image.open(filename)
+            image.thumbnail(self.THUMB_SIZE)
+            image.save(thumb, 'JPEG')
+        except Exception:
+            return None
+        return thumb
+
+    def _enforce_retention(self, conn):
+        # delete oldest first, a batch at a time, until under both limits
+        cutoff = time.time() - self.max_age_days * 86400
+        try:
+            while True:
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM snapshots').fetchone()[0]
+                oldest = conn.execute('SELECT path, ts, size, thumb FROM snapshots ORDER BY ts, rowid LIMIT ?', (self.DELETE_BATCH,)).fetchall()
+                doomed = []
+                for path, ts, size, thumb in oldest:
+                    if ts >= cutoff and total <= self.max_bytes:
+                        break
+                    doomed.append((path, thumb))
+                    total -= size
+                if not doomed:
+                    return
+                for path, thumb in doomed:
+                    for one_file in (path, thumb):
+                        try:
+                            if one_file and os.path.exists(one_file):
+                                os.remove(one_file)
+                        except OSError, e:
+                            self.log('Snapshot archive: failed to remove %s: %s' % (one_file, e))
+                with conn:
+                    conn.executemany('DELETE FROM snapshots WHERE path = ?', [(path,) for path, thumb in doomed])
+        except Exception, e:
+            self.log('Snapshot archive: retention pass failed: %s' % e)
+
+
+# The running archive, if any; webcam_snap reports each new snapshot to it
+archive = None
+
+
+def find_snapshots(out_dir=OUTDIR, label=None, since=None, until=None, limit=50):
+    """newest first, as (path, ts, label, size, thumb) tuples, straight from the index"""
+    index_file = os.path.join(out_dir, 'snapshots.db')
+    if not os.path.exists(index_file):
+        return []
+    # no PRAGMAs, no DDL; a reader shouldn't change the file
+    conn = sqlite3.connect(index_file, timeout=10)
+    sql = 'SELECT path, ts, label, size, thumb FROM snapshots WHERE ts >= ? AND ts < ?'
+    params = [since or 0, until or time.time() + 86400]
+    if label:
+        sql += ' AND label = ?'
+        params.append(label)
+    sql += ' ORDER BY ts DESC, rowid DESC LIMIT ?'
+    params.append(limit)
+    try:
+        return conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        return []  # no snapshots table yet
+    finally:
+        conn.close()
+
+
+def start_archive(**kwargs):
+    """start the snapshot archive process; kwargs go to SnapshotArchive"""
+    global archive
+    archive = SnapshotArchive(**kwargs)
+    archive.start()
+    return archive
+
+
 if __name__ == '__main__':
 
     import datetime    
-    webcam_snap('noon', datetime.datetime.now())
+    if len(sys.argv) > 1 and sys.argv[1] == 'find':
+        # e.g. ./webcam.py find close 20
+        label = sys.argv[2] if len(sys.argv) > 2 else None
+        limit = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+        for path, ts, label, size, thumb in find_snapshots(label=label, limit=limit):
+            print datetime.datetime.fromtimestamp(ts), label, size, path, thumb or ''
+    else:
+        webcam_snap('noon', datetime.datetime.now())